@@ -1,7 +1,8 @@
 import time
 import pandas as pd
 import numpy as np
-import pmdarima as pm
+from statsforecast import StatsForecast
+from statsforecast.models import ARIMA, AutoARIMA
 from sklearn.metrics import (
     mean_squared_error,
     r2_score,
@@ -9,6 +10,7 @@ from sklearn.metrics import (
     mean_absolute_error,
     median_absolute_error,
 )
+from data_loader import load_data
 
 
 
@@ -17,27 +19,39 @@ class ARIMAForecaster:
     A class used to forecast CNS deaths using the ARIMA model.
     """
 
-    def __init__(self, excel_file):
+    def __init__(self, excel_file, n_jobs=-1, truncate=None):
         """
         Initializes the ARIMAForecaster with the given Excel file.
 
         :param excel_file: str, path to the Excel file containing the data.
-        """
-        self.excel_data = pd.read_excel(excel_file, sheet_name=None)
-        self.combined_data = self.prepare_data()
+        :param n_jobs: int, number of worker processes used to fit the cities in parallel (-1 uses all cores).
+        :param truncate: int, number of most recent observations used to select each ARIMA order (None uses all).
+        """
+        self.n_jobs = n_jobs
+        self.combined_data = load_data(excel_file)
+        self.panel_data = self.prepare_panel()
+        self.model = AutoARIMA(
+            max_p=3,
+            max_q=3,
+            max_d=2,
+            season_length=1,
+            stepwise=True,
+            approximation=True,
+            truncate=truncate,
+            ic="aic",
+        )
+        self._order_cache = {}
 
-    def prepare_data(self):
+    def prepare_panel(self):
         """
-        Combines the data from all sheets in the Excel file into a single DataFrame.
+        Reshapes the combined data into the long format expected by StatsForecast.
 
-        :return: DataFrame, combined data from all sheets.
+        :return: DataFrame, with one row per (unique_id, ds) pair and the target in y.
         """
-        data_frames = [
-            df.assign(year=int(sheet_name))
-            for sheet_name, df in self.excel_data.items()
-        ]
-        combined_data = pd.concat(data_frames)
-        return combined_data
+        panel_data = self.combined_data[["comune", "year", "cns deaths"]].rename(
+            columns={"comune": "unique_id", "year": "ds", "cns deaths": "y"}
+        )
+        return panel_data
 
     def split_data(self, train_year=2018, test_year=2019):
         """
@@ -48,61 +62,95 @@ class ARIMAForecaster:
         """
         self.train_data = self.combined_data[self.combined_data["year"] <= train_year]
         self.test_data = self.combined_data[self.combined_data["year"] == test_year]
-
-    def predict_arima(self, city_data):
-        """
-        Trains an ARIMA model on the given city data and returns the prediction for the next period.
-
-        :param city_data: DataFrame, data for a specific city.
-        :return: float, prediction for the next period.
-        """
-        city_data = city_data.reset_index(drop=True)
-        temp_index = pd.date_range(start="2000-01-01", periods=len(city_data), freq="A")
-        city_data = city_data.set_index(temp_index)
-
-        model = pm.auto_arima(
-            city_data["cns deaths"],
-            seasonal=False,
-            stepwise=True,
-            suppress_warnings=True,
-            trace=False,
-            error_action="ignore",
-            information_criterion="aic",
+        self.train_panel = self.panel_data[self.panel_data["ds"] <= train_year]
+        self.test_panel = self.panel_data[self.panel_data["ds"] == test_year]
+
+    def predict_arima(self, panel_data):
+        """
+        Trains an ARIMA model on every city in the given panel and returns the prediction for the next period.
+
+        :param panel_data: DataFrame, long-format data with unique_id, ds and y columns.
+        :return: DataFrame, one row per city with the columns unique_id and prediction.
+        """
+        sf = StatsForecast(models=[self.model], freq=1, n_jobs=self.n_jobs)
+        sf.fit(df=panel_data)
+        for comune, model in zip(sf.uids, sf.fitted_[:, 0]):
+            p, q, _, _, _, d, _ = model.model_["arma"]
+            coef = model.model_["coef"]
+            self._order_cache[comune] = (
+                (p, d, q),
+                "intercept" in coef,
+                "drift" in coef,
+            )
+
+        forecast = sf.predict(h=1)
+        return forecast[["unique_id", "AutoARIMA"]].rename(
+            columns={"AutoARIMA": "prediction"}
         )
 
-        forecast, conf_int = model.predict(n_periods=1, return_conf_int=True)
-        return forecast[0]
+    def predict_arima_fixed(self, panel_data):
+        """
+        Refits every city in the given panel with the ARIMA order previously selected for it and returns the
+        prediction for the next period.
+
+        Cities sharing an order are fitted together in this process: a fixed-order fit is cheap, so starting a pool of
+        worker processes for it costs more than it saves. Cities without a cached order, or whose fixed-order fit
+        fails, fall back to the full order search.
+
+        :param panel_data: DataFrame, long-format data with unique_id, ds and y columns.
+        :return: DataFrame, one row per city with the columns unique_id and prediction.
+        """
+        city_panels = dict(iter(panel_data.groupby("unique_id", sort=False)))
+        comuni_by_spec = {}
+        uncached = []
+        for comune in city_panels:
+            if comune in self._order_cache:
+                comuni_by_spec.setdefault(self._order_cache[comune], []).append(comune)
+            else:
+                uncached.append(comune)
+
+        forecasts = []
+        if uncached:
+            forecasts.append(
+                self.predict_arima(pd.concat([city_panels[c] for c in uncached]))
+            )
+
+        for (order, include_mean, include_drift), comuni in comuni_by_spec.items():
+            model = ARIMA(
+                order=order, include_mean=include_mean, include_drift=include_drift
+            )
+            sf = StatsForecast(
+                models=[model], freq=1, n_jobs=1, fallback_model=self.model
+            )
+            forecast = sf.forecast(df=pd.concat([city_panels[c] for c in comuni]), h=1)
+            forecasts.append(
+                forecast[["unique_id", "ARIMA"]].rename(columns={"ARIMA": "prediction"})
+            )
+
+        return pd.concat(forecasts).sort_values("unique_id", ignore_index=True)
 
     def train_and_evaluate(self):
         """
         Trains the ARIMA model for each city in the dataset and evaluates the performance using various metrics.
         """
-        predictions = []
         start_time = time.time()
-        for comune in self.combined_data["comune"].unique():
-            city_train_data = self.train_data[self.train_data["comune"] == comune]
-            city_test_data = self.test_data[self.test_data["comune"] == comune]
-
-            if not city_train_data.empty and not city_test_data.empty:
-                prediction = self.predict_arima(city_train_data)
-                predictions.append(
-                    (comune, prediction, city_test_data.iloc[0]["cns deaths"])
-                )
+        forecast = self.predict_arima(self.train_panel)
+        forecast = forecast.merge(self.test_panel, on="unique_id")
+        y_pred = forecast["prediction"].to_numpy(dtype=np.float64)
+        y_true = forecast["y"].to_numpy(dtype=np.float64)
 
         end_time = time.time()
         self.total_time = end_time - start_time
-        self.predictions = predictions
-        self.calculate_evaluation_metrics(predictions)
+        self.predictions = list(zip(forecast["unique_id"], y_pred, y_true))
+        self.calculate_evaluation_metrics(y_true, y_pred)
 
-    def calculate_evaluation_metrics(self, predictions):
+    def calculate_evaluation_metrics(self, y_true, y_pred):
         """
         Calculates evaluation metrics for the ARIMA model predictions.
 
-        :param predictions: list, tuples containing (city, predicted_value, true_value).
+        :param y_true: ndarray, true values for each city.
+        :param y_pred: ndarray, predicted values for each city.
         """
-        y_true = [p[2] for p in predictions]
-        y_pred = [p[1] for p in predictions]
-
         self.mse = mean_squared_error(y_true, y_pred)
         self.rmse = np.sqrt(self.mse)
         self.r2 = r2_score(y_true, y_pred)
@@ -116,14 +164,10 @@ class ARIMAForecaster:
 
         :param year: int, year for which predictions should be made (default: 2020).
         """
-        upcoming_year_data = self.combined_data[self.combined_data["year"] == year]
-        predictions_upcoming_year = []
-        for comune in self.combined_data["comune"].unique():
-            city_train_data = self.combined_data[self.combined_data["comune"] == comune]
-
-            if not city_train_data.empty:
-                prediction = self.predict_arima(city_train_data)
-                predictions_upcoming_year.append((comune, prediction))
+        forecast = self.predict_arima_fixed(self.panel_data)
+        predictions_upcoming_year = list(
+            zip(forecast["unique_id"], forecast["prediction"])
+        )
 
         self.save_predictions(predictions_upcoming_year)
 
@@ -152,8 +196,9 @@ class ARIMAForecaster:
 
 
 # Usage
-forecaster = ARIMAForecaster("main_data_cities_V2.xlsx")
-forecaster.split_data()
-forecaster.train_and_evaluate()
-forecaster.predict_upcoming_year()
-forecaster.print_evaluation_metrics()
+if __name__ == "__main__":
+    forecaster = ARIMAForecaster("main_data_cities_V2.xlsx")
+    forecaster.split_data()
+    forecaster.train_and_evaluate()
+    forecaster.predict_upcoming_year()
+    forecaster.print_evaluation_metrics()
@@ -0,0 +1,51 @@
+import os
+import tempfile
+import pandas as pd
+import pyarrow as pa
+
+
+def load_data(excel_file):
+    """
+    Loads the data from all sheets in the Excel file into a single DataFrame with a year column taken from the
+    sheet names.
+
+    The combined data is cached in a Parquet file next to the Excel file and read from there on later runs, as long
+    as the Excel file has not been modified since. The cache is written to a temporary file and moved into place, and
+    an unreadable or unwritable cache falls back to parsing the Excel file.
+
+    :param excel_file: str, path to the Excel file containing the data.
+    :return: DataFrame, combined data from all sheets.
+    """
+    parquet_file = os.path.splitext(excel_file)[0] + ".parquet"
+    if os.path.exists(parquet_file) and os.path.getmtime(
+        parquet_file
+    ) >= os.path.getmtime(excel_file):
+        try:
+            return pd.read_parquet(parquet_file, engine="pyarrow")
+        except (OSError, ValueError, pa.ArrowException):
+            pass
+
+    excel_data = pd.read_excel(excel_file, sheet_name=None)
+    combined_data = (
+        pd.concat(
+            {int(sheet_name): df for sheet_name, df in excel_data.items()},
+            names=["year", None],
+        )
+        .reset_index(level="year")
+        .reset_index(drop=True)
+    )
+    temp_file = None
+    try:
+        fd, temp_file = tempfile.mkstemp(
+            dir=os.path.dirname(parquet_file) or ".",
+            prefix=os.path.basename(parquet_file) + ".",
+            suffix=".tmp.parquet",
+        )
+        os.close(fd)
+        os.chmod(temp_file, 0o644)
+        combined_data.to_parquet(temp_file, engine="pyarrow", compression="zstd")
+        os.replace(temp_file, parquet_file)
+    except (OSError, pa.ArrowException):
+        if temp_file is not None and os.path.exists(temp_file):
+            os.remove(temp_file)
+    return combined_data